@@ -13,16 +13,73 @@ Description: Custom fuzzy matcher.
 # =================================================================================================
 # PACKAGES
 # =================================================================================================
-from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
 from math import comb
+from multiprocessing import shared_memory
+import os
 import re
 import time
 import pandas as pd
 import numpy as np
-from pathos.multiprocessing import ProcessingPool as Pool
 
-from f1_preproc_strings import preproc_string
-from c2_fuzz_scorer import FuzzyScorer
+from f1_preproc_strings import preproc_string, compile_trim_words
+from c2_fuzz_scorer import FuzzyScorer, score_upper_bound, length_ratio, length_range
+
+
+# =================================================================================================
+# PREPROCESSING CACHE
+# =================================================================================================
+# preprocessed (registrant, fund) of the raw strings, for each preprocessing setting and role
+# the same names are preprocessed again and again, e.g., every quarter in s1
+# the caches roll with the calls: only the strings of the latest call are kept, consecutive
+# matching horizons overlap, so most strings are hits and the caches don't grow over the run
+_PREPROC_CACHE = {}
+
+
+# =================================================================================================
+# MULTIPROCESSING
+# =================================================================================================
+# state of the current worker process (shared memory blocks and prepared find_cur_best)
+_WORKER = {}
+
+
+def share_array(array):
+    """
+    Copy a numpy array into shared memory, so worker processes can map it instead of unpickling it.
+    Returns the shared memory block and the specification (name, shape, dtype) to attach to it.
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def init_worker(specs, settings):
+    """
+    Initialize a worker process: attach the choices and prepare find_cur_best with the settings.
+    Arguments:
+        specs (list) - shared memory specifications of the choices (or the arrays themselves)
+        settings (dict) - keyword arguments of wrapper_find_cur_best
+    """
+    _WORKER['shm'], arrays = [], []
+    for spec in specs:
+        # object arrays cannot be shared and were passed directly
+        if isinstance(spec, np.ndarray):
+            arrays.append(spec)
+            continue
+        name, shape, dtype = spec
+        shm = shared_memory.SharedMemory(name=name)
+        _WORKER['shm'].append(shm)
+        arrays.append(np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    _WORKER['find_func'] = FuzzyFundMatcher.wrapper_find_cur_best(*arrays, **settings)
+
+
+def find_cur_best_worker(regfund):
+    """
+    Run find_cur_best for a single (registrant, fund, row) tuple in a worker process
+    (row is the position of the registrant in the matrix of registrant bounds)
+    """
+    return _WORKER['find_func'](regfund)
 
 
 # =================================================================================================
@@ -47,6 +104,15 @@ class FuzzyFundMatcher:
 
         self.to_matches_r = self.to_matches_f = None
         self.choices_r = self.choices_f = None
+        self.choices_r_unique = self.choices_f_unique = None
+        self.choices_r_inverse = self.choices_f_inverse = None
+        self.choices_r_token = self.choices_f_token = None
+        self.choices_r_len = self.choices_f_len = None
+        self.choices_order = None
+
+        # pool of worker processes and shared memory, kept alive between find_best calls
+        self.pool = self.pool_settings = None
+        self.shared_memory = []
 
         # keep track of match positions, they will be returned to assist in identification
         # e.g., to get fund number of match or other information
@@ -65,10 +131,15 @@ class FuzzyFundMatcher:
         Preprocess the strings to assist in matching.
         Arguments:
             trim_words (list of strings) - words that will be removed, also known as stop words
-            regex_sub (list of tuples: (regex expression, substitution)) - regex substitutions to apply
+            regex_sub (list of tuples: (regex expression, substitution)) - regex substitutions to apply,
+                the regex expressions can also be pre-compiled
         """
-        # pre-compile the regular expressions
-        regex_sub = [(re.compile(regex), sub) for regex, sub in regex_sub]
+        # workers of a running pool hold the previously preprocessed choices, so they cannot be reused
+        self.close_pool()
+
+        # pre-compile the regular expressions (cached, preproc runs with the same lists every quarter)
+        trim_words, regex_sub = FuzzyFundMatcher.compile_patterns(tuple(trim_words or ()),
+                                                                  tuple(map(tuple, regex_sub or ())))
 
         # combine registrant and fund name by removing the separator
         if combine_reg_fund:
@@ -79,84 +150,286 @@ class FuzzyFundMatcher:
         try:
             start = time.time()
 
-            self.to_matches_r, self.to_matches_f = preproc_string(self.to_matches,
-                                                                  trim_words=trim_words,
-                                                                  regex_sub=regex_sub,
-                                                                  rem_reg_from_fund=rem_reg_from_fund)
-
-            self.choices_r, self.choices_f = preproc_string(self.choices,
-                                                            trim_words=trim_words,
-                                                            regex_sub=regex_sub,
-                                                            rem_reg_from_fund=rem_reg_from_fund)
+            self.to_matches_r, self.to_matches_f = FuzzyFundMatcher.preproc_cached(self.to_matches,
+                                                                                   trim_words=trim_words,
+                                                                                   regex_sub=regex_sub,
+                                                                                   rem_reg_from_fund=rem_reg_from_fund,
+                                                                                   role='to_matches')
+
+            self.choices_r, self.choices_f = FuzzyFundMatcher.preproc_cached(self.choices,
+                                                                             trim_words=trim_words,
+                                                                             regex_sub=regex_sub,
+                                                                             rem_reg_from_fund=rem_reg_from_fund,
+                                                                             role='choices')
+
+            # sort the choices by registrant length, so the choices with a feasible registrant length
+            # are a contiguous slice in the quick comparison (match positions keep track of the order)
+            # the original positions are kept as well, ties in the final ranking are broken by them
+            order = np.argsort(np.char.str_len(self.choices_r), kind='stable')
+            self.choices_r, self.choices_f = self.choices_r[order], self.choices_f[order]
+            self.match_pos = np.asarray(self.match_pos)[order]
+            self.choices_order = order
+
+            # identify unique choices, since the same registrant and fund names appear many times
+            # scores are computed once per unique name and mapped back with the inverse index
+            self.choices_r_unique, self.choices_r_inverse = np.unique(self.choices_r, return_inverse=True)
+            self.choices_f_unique, self.choices_f_inverse = np.unique(self.choices_f, return_inverse=True)
+
+            # sort the words of every unique choice once for matching with order irrelevance
+            self.choices_r_token = np.array([FuzzyScorer.sort_and_token(c) for c in self.choices_r_unique])
+            self.choices_f_token = np.array([FuzzyScorer.sort_and_token(c) for c in self.choices_f_unique])
+
+            # string lengths of all choices for the quick comparison
+            self.choices_r_len = np.char.str_len(self.choices_r)
+            self.choices_f_len = np.char.str_len(self.choices_f)
 
             print(f"Applying regular expressions took {int(time.time()-start)} seconds.")
         except TypeError:
             return
 
     def find_best(self, top_n=3, valid_threshold=0, digit_multiplier=1, multi_processing=False,
-                  quick_comparison=False, order_irrelevance=False):
+                  quick_comparison=False, order_irrelevance=False, multi_threading=False, workers=-1):
         """
         Find the best matching choices for each to_match
         Arguments:
             top_n (integer) - number of top results to be included in output
             valid_threshold (numeric, in 0-100) - threshold for registrant and fund stage
             digit_multiplier (numeric, >0) - multiplier for un-matched digit penalty
+            multi_threading (boolean) - use threads instead of processes if multi_processing is on,
+                threads share the choices without copies, but only rapidfuzz and numpy release the GIL
+            workers (integer) - number of threads rapidfuzz uses for the registrant bounds (-1 for all cores)
         """
-        # prepare function and inputs for multiprocessing pool or single-core list comprehension
-        find_func = FuzzyFundMatcher.wrapper_find_cur_best(self.choices_r, self.choices_f,
-                                                           self.match_pos, top_n=top_n,
-                                                           valid_threshold=valid_threshold,
-                                                           digit_multiplier=digit_multiplier,
-                                                           quick_comparison=quick_comparison,
-                                                           order_irrelevance=order_irrelevance)
-
-        RegFund = namedtuple('Registrant_Fund', 'registrant fund')
-        reg_funds = [RegFund(reg, fund) for reg, fund in zip(self.to_matches_r, self.to_matches_f)]
+        # prepare settings for multiprocessing pool or single-core list comprehension
+        settings = dict(top_n=top_n, valid_threshold=valid_threshold, digit_multiplier=digit_multiplier,
+                        quick_comparison=quick_comparison, order_irrelevance=order_irrelevance)
+
+        # many to_matches are identical after preprocessing (e.g., share classes of the same fund),
+        # so only the unique (registrant, fund) pairs are matched and mapped back with the inverse index
+        # (preprocessed strings do not contain ':', so the names identify the pairs)
+        names = np.char.add(np.char.add(self.to_matches_r, ' : '), self.to_matches_f)
+        names, unique_pos, unique_inverse = np.unique(names, return_index=True, return_inverse=True)
+        to_matches_r, to_matches_f = self.to_matches_r[unique_pos], self.to_matches_f[unique_pos]
+
+        # many to_matches share the same registrant, so compute the registrant bounds for all
+        # unique registrants at once, rapidfuzz scores all combinations in C using all cores
+        registrants, rows = np.unique(to_matches_r, return_inverse=True)
+        registrant_bounds = self.compute_registrant_bounds(registrants, valid_threshold, order_irrelevance,
+                                                           digit_multiplier, workers)
+        arrays = self.get_choices() + (registrant_bounds,)
+
+        # stream of (registrant, fund, row) tuples
+        reg_funds = zip(to_matches_r, to_matches_f, rows)
 
         # compute
-        if multi_processing:
-            # compute and terminate pool for next iteration
-            pool = Pool()
-            matches = pool.map(find_func, reg_funds)
-            pool.terminate()
-            pool.restart()
+        if multi_processing and multi_threading:
+            # threads work on the same arrays, nothing is pickled or copied into shared memory
+            find_func = FuzzyFundMatcher.wrapper_find_cur_best(*arrays, **settings)
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+                matches = list(pool.map(find_func, reg_funds))
+        elif multi_processing:
+            # workers already hold the choices, only the (registrant, fund, row) tuples are sent
+            pool = self.start_pool(arrays, settings)
+            chunksize = max(1, len(rows) // (4*os.cpu_count()))
+            matches = list(pool.map(find_cur_best_worker, reg_funds, chunksize=chunksize))
         else:
             # single-core list comprehension
+            find_func = FuzzyFundMatcher.wrapper_find_cur_best(*arrays, **settings)
             matches = [find_func(rf) for rf in reg_funds]
 
         # finish output
-        output = []
-        Match = namedtuple('Match', 'to_match matches')
-        for mat, registrant, fund in zip(matches, self.to_matches_r, self.to_matches_f):
-            if mat:
-                # output format: [[name, (m_name1, m_score1, m_pos1),
-                #                  (m_name2, m_score2, m_pos2)], ...]
-                output.append(Match(f'{registrant} : {fund}', mat))
-            else:
-                output += [None]
+        # count the matches of every unique to_match in a single pass (None means no match),
+        # map the counts back to all to_matches and identify the to_matches with at least one match
+        counts = np.fromiter((0 if mat is None else len(mat[0]) for mat in matches),
+                             dtype=np.int64, count=len(matches))[unique_inverse]
+        matched = np.flatnonzero(counts)
+        counts = counts[matched]
+        to_match = names[unique_inverse[matched]]
+        matches = [matches[i] for i in unique_inverse[matched]]
+
+        # concatenate the match arrays (picks, scores, positions, flags) of all to_matches,
+        # empty arrays are added so the columns have the right type if nothing is matched
+        empty = (np.array([], dtype=str), np.array([], dtype=np.int16),
+                 self.match_pos[:0], np.array([], dtype=str))
+        picks, scores, positions, flags = [np.concatenate(column) for column in zip(empty, *matches)]
+
+        # output format: structured array with one entry per match, sorted by to_match and score
+        # [(row, name, m_name1, m_score1, m_pos1, m_flag1),
+        #  (row, name, m_name2, m_score2, m_pos2, m_flag2), ...]
+        # row is the position of the to_match, to_matches without any match do not appear
+        output = np.empty(len(picks), dtype=[('row', np.int64), ('to_match', to_match.dtype),
+                                             ('pick', picks.dtype), ('score', np.int16),
+                                             ('pos', positions.dtype), ('flag', 'U2')])
+        output['row'] = np.repeat(matched, counts)
+        output['to_match'] = np.repeat(to_match, counts)
+        output['pick'], output['score'], output['pos'], output['flag'] = picks, scores, positions, flags
         return output
 
+    @staticmethod
+    def preproc_cached(strings, trim_words=None, regex_sub=None, rem_reg_from_fund=False, role=None):
+        """
+        Apply preproc_string, but only to the strings that were not preprocessed in the latest call
+        with the same settings and role (duplicates are only preprocessed once as well)
+        Arguments:
+            strings (list of strings) - strings of the form 'REGISTRANT: FUND'
+            trim_words (compiled regex) - trim words, see compile_patterns
+            regex_sub (list of tuples: (compiled regex, substitution)) - regex substitutions to apply
+            role (string) - separates the caches of strings used differently, e.g., choices and to_matches
+        """
+        if len(strings) == 0:
+            return None
+
+        # categorical strings are preprocessed once per (used) category and mapped back with the codes
+        if isinstance(getattr(strings, 'dtype', None), pd.CategoricalDtype):
+            strings = strings.cat.remove_unused_categories()
+            st_r, st_f = FuzzyFundMatcher.preproc_cached(strings.cat.categories, trim_words=trim_words,
+                                                         regex_sub=regex_sub, rem_reg_from_fund=rem_reg_from_fund,
+                                                         role=role)
+            codes = strings.cat.codes.to_numpy()
+            return st_r[codes], st_f[codes]
+
+        key = (trim_words, tuple(regex_sub), rem_reg_from_fund, role)
+        cache = _PREPROC_CACHE.get(key, {})
+
+        # preprocess the new strings and add them to the cache
+        new = list(dict.fromkeys(s for s in strings if s not in cache))
+        if new:
+            st_r, st_f = preproc_string(new, trim_words=trim_words, regex_sub=regex_sub,
+                                        rem_reg_from_fund=rem_reg_from_fund)
+            cache.update(zip(new, zip(np.atleast_1d(st_r).tolist(), np.atleast_1d(st_f).tolist())))
+
+        # keep only the strings of this call for the next one
+        _PREPROC_CACHE[key] = {s: cache[s] for s in strings}
+
+        st_r, st_f = zip(*[cache[s] for s in strings])
+        return np.array(st_r), np.array(st_f)
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def compile_patterns(trim_words, regex_sub):
+        """
+        Compile the trim words into a single regular expression and pre-compile the regex substitutions
+        Arguments:
+            trim_words (tuple of strings) - words that will be removed
+            regex_sub (tuple of tuples: (regex expression, substitution)) - regex substitutions to apply
+        """
+        return compile_trim_words(trim_words), [(re.compile(regex), sub) for regex, sub in regex_sub]
+
+    def get_choices(self):
+        """
+        Return the preprocessed choices in the order expected by wrapper_find_cur_best
+        """
+        return (np.asarray(self.choices_r), np.asarray(self.choices_f), np.asarray(self.match_pos),
+                self.choices_order, self.choices_r_unique, self.choices_r_inverse, self.choices_r_token,
+                self.choices_f_unique, self.choices_f_inverse, self.choices_f_token,
+                self.choices_r_len, self.choices_f_len)
+
+    def compute_registrant_bounds(self, registrants, valid_threshold=0, order_irrelevance=False,
+                                  digit_multiplier=1, workers=-1, block_size=1024):
+        """
+        Compute the upper bounds on the registrant scores for every registrant and unique choice.
+        Registrants are processed in blocks to limit the memory of intermediate results.
+        Arguments:
+            registrants (array of strings) - preprocessed registrants that need to be matched
+            workers (integer) - number of threads used by rapidfuzz (-1 for all cores)
+            block_size (integer) - number of registrants scored in one rapidfuzz call
+        """
+        bounds = np.zeros((len(registrants), len(self.choices_r_unique)), dtype=np.uint8)
+        for start in range(0, len(registrants), block_size):
+            bounds[start:start+block_size] = FuzzyFundMatcher.compute_bound(registrants[start:start+block_size],
+                                                                            self.choices_r_unique,
+                                                                            self.choices_r_token,
+                                                                            valid_threshold, order_irrelevance,
+                                                                            digit_multiplier, workers)
+        return bounds
+
+    def start_pool(self, arrays, settings):
+        """
+        Start a pool of worker processes holding the choices in shared memory.
+        The pool is reused by later find_best calls as long as the settings do not change
+        (preproc changes the choices and shuts the pool down, so one pool serves one set of choices).
+        Arguments:
+            arrays (tuple of arrays) - choices and registrant bounds, see wrapper_find_cur_best
+            settings (dict) - keyword arguments of wrapper_find_cur_best
+        """
+        if self.pool is not None and self.pool_settings == settings:
+            return self.pool
+        self.close_pool()
+
+        # copy the choices into shared memory once, workers attach to it during initialization
+        specs = []
+        for array in arrays:
+            if array.dtype.hasobject:
+                specs.append(array)
+            else:
+                shm, spec = share_array(array)
+                self.shared_memory.append(shm)
+                specs.append(spec)
+
+        self.pool = ProcessPoolExecutor(initializer=init_worker, initargs=(specs, settings))
+        self.pool_settings = settings
+        return self.pool
+
+    def close_pool(self):
+        """
+        Shut down the pool of worker processes and release the shared memory
+        """
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = self.pool_settings = None
+        for shm in self.shared_memory:
+            shm.close()
+            shm.unlink()
+        self.shared_memory = []
+
     # staticmethod is required for efficient multiprocessing execution
     @staticmethod
-    def wrapper_find_cur_best(choices_r, choices_f, match_pos, top_n, valid_threshold, digit_multiplier,
-                              quick_comparison=False, order_irrelevance=False):
+    def wrapper_find_cur_best(choices_r, choices_f, match_pos, choices_order, choices_r_unique,
+                              choices_r_inverse, choices_r_token, choices_f_unique, choices_f_inverse,
+                              choices_f_token, choices_r_len, choices_f_len, registrant_bounds, top_n, valid_threshold,
+                              digit_multiplier, quick_comparison=False, order_irrelevance=False):
         """
         Wrapper for efficient multiprocessing execution of find_cur_best
         """
-        return lambda regfund: FuzzyFundMatcher.find_cur_best(regfund.registrant, regfund.fund, choices_r, choices_f,
-                                                              match_pos, top_n, valid_threshold, digit_multiplier,
+        return lambda regfund: FuzzyFundMatcher.find_cur_best(regfund[0], regfund[1], registrant_bounds[regfund[2]],
+                                                              choices_r, choices_f, match_pos, choices_order,
+                                                              choices_r_inverse, choices_r_token, choices_f_unique,
+                                                              choices_f_inverse, choices_f_token, choices_r_len,
+                                                              choices_f_len, top_n, valid_threshold, digit_multiplier,
                                                               quick_comparison, order_irrelevance)
 
+    @staticmethod
+    def compute_bound(to_match, choices, choices_token, valid_threshold=0, order_irrelevance=False,
+                      digit_multiplier=1, workers=1):
+        """
+        Compute an upper bound on the score of to_match (string or array of strings) for every choice at once
+        (bounds below valid_threshold are set to 0)
+        choices_token holds the choices with sorted words, it is only used with order irrelevance
+        """
+        bound = score_upper_bound(to_match, choices, valid_threshold, workers, digit_multiplier)
+        if order_irrelevance:
+            to_match_token = (FuzzyScorer.sort_and_token(to_match) if isinstance(to_match, str)
+                              else [FuzzyScorer.sort_and_token(e) for e in to_match])
+            bound = np.maximum(bound, score_upper_bound(to_match_token, choices_token, valid_threshold, workers,
+                                                        digit_multiplier))
+        return bound
+
     # staticmethod is required for efficient multiprocessing execution
     @staticmethod
-    def find_cur_best(registrant, fund, choices_r, choices_f, match_pos,
-                      top_n=3, valid_threshold=0, digit_multiplier=1,
+    def find_cur_best(registrant, fund, registrant_bound, choices_r, choices_f, match_pos, choices_order,
+                      choices_r_inverse, choices_r_token, choices_f_unique, choices_f_inverse, choices_f_token,
+                      choices_r_len, choices_f_len, top_n=3, valid_threshold=0, digit_multiplier=1,
                       quick_comparison=False, order_irrelevance=False):
         """
         Find the best matching choice for the current to_match
+        (registrant_bound holds the upper bounds of the registrant for the unique choices)
         """
         # rcr (remaining choices registrants), rcf (remaining choices funds)
         # rrsc (remaining registrant scores), rpos (remaining positional identifiers)
+        # rord (remaining original positions of the choices, they break ties in the ranking)
+        # rinr, rinf (remaining inverse indices into the unique registrants and funds)
+        rcr, rcf, rpos, rord = choices_r, choices_f, match_pos, choices_order
+        rinr, rinf = choices_r_inverse, choices_f_inverse
+
         # =========================================================================================
         # QUICK COMPARISON
         # =========================================================================================
@@ -165,32 +438,18 @@ class FuzzyFundMatcher:
         # if the upper bound is too low, then discard immediately
         if quick_comparison:
             try:
-                # first do check for registrant part
-                # intialize fuzzy scorer
-                fus = FuzzyScorer(to_match=registrant,
-                                  digit_multiplier=digit_multiplier)
-                valid = []
-                for choice in choices_r:
-                    fus.set_choice(choice)
-                    valid.append(fus.real_quick_ratio() >= valid_threshold)
-                valid = np.array(valid)
-
-                # only keep remaining candidates
-                rcr, rcf = choices_r[valid], choices_f[valid]
-                rpos = match_pos[valid]
+                # choices are sorted by registrant length, the feasible registrant lengths are a slice
+                lo, hi = length_range(len(registrant), valid_threshold, digit_multiplier)
+                feasible = slice(np.searchsorted(choices_r_len, lo, side='left'),
+                                 np.searchsorted(choices_r_len, hi, side='right'))
 
-                # repeat for fund part
-                fus = FuzzyScorer(to_match=fund,
-                                  digit_multiplier=digit_multiplier)
-                valid = []
-                for choice in rcf:
-                    fus.set_choice(choice)
-                    valid.append(fus.real_quick_ratio() >= valid_threshold)
-                valid = np.array(valid)
+                # check the fund part within the slice using the pre-computed lengths
+                valid = length_ratio(len(fund), choices_f_len[feasible], digit_multiplier) >= valid_threshold
 
                 # only keep remaining candidates
-                rcr, rcf = rcr[valid], rcf[valid]
-                rpos = rpos[valid]
+                rcr, rcf = choices_r[feasible][valid], choices_f[feasible][valid]
+                rpos, rord = match_pos[feasible][valid], choices_order[feasible][valid]
+                rinr, rinf = rinr[feasible][valid], rinf[feasible][valid]
 
             except TypeError:
                 return None
@@ -198,15 +457,46 @@ class FuzzyFundMatcher:
                 return None
 
         # =========================================================================================
-        # REGISTRANT MATCHING
+        # UPPER BOUNDS
+        # =========================================================================================
+        # check the upper bounds of registrant and fund score at once and only keep candidates
+        # that can still pass the threshold in both parts
+        try:
+            # look up the pre-computed upper bound on the registrant score for all candidates
+            valid = registrant_bound[rinr] >= valid_threshold
+
+            # check whether at least one candidate is left, otherwise abort
+            if ~valid.any():
+                return None
+
+            # compute an upper bound on the fund score for all candidates at once
+            # only the unique fund names among the candidates with a valid registrant bound are scored
+            unique_pos, unique_inverse = np.unique(rinf[valid], return_inverse=True)
+            bound = FuzzyFundMatcher.compute_bound(fund, choices_f_unique[unique_pos],
+                                                   choices_f_token[unique_pos], valid_threshold,
+                                                   order_irrelevance, digit_multiplier)[unique_inverse]
+            valid[valid] = bound >= valid_threshold
+
+            # check whether at least one candidate is left, otherwise abort
+            if ~valid.any():
+                return None
+            rcr, rcf = rcr[valid], rcf[valid]
+            rpos, rord = rpos[valid], rord[valid]
+            rinr, rinf = rinr[valid], rinf[valid]
+        except TypeError:
+            return None
+
+        # =========================================================================================
+        # EXACT SCORES
         # =========================================================================================
-        # first match registrants and only keep valid candidates
+        # compute the exact registrant and fund scores of the remaining candidates,
+        # the fund score is only computed if the registrant score is sufficiently high
         try:
             # intialize fuzzy scorer
             fus = FuzzyScorer(to_match=registrant,
                               digit_multiplier=digit_multiplier)
 
-            # compute score for every combination
+            # compute exact score for every remaining combination
             rrsc = []
             for choice in rcr:
                 fus.set_choice(choice)
@@ -217,10 +507,10 @@ class FuzzyFundMatcher:
             if order_irrelevance:
                 half_valid_threshold = int(valid_threshold/3) # this is on purpose, half is not enough
                 rrsc_token = []
-                fus = FuzzyScorer(to_match=registrant,
-                                  digit_multiplier=digit_multiplier,
-                                  sorted_token=True)
-                for choice, cur_rrsc in zip(rcr, rrsc):
+                # words of the choices are already sorted, only sort the current registrant
+                fus = FuzzyScorer(to_match=FuzzyScorer.sort_and_token(registrant),
+                                  digit_multiplier=digit_multiplier)
+                for choice, cur_rrsc in zip(choices_r_token[rinr], rrsc):
                     # no need to try if score is 100 or less than half of valid_threshold
                     if cur_rrsc == 100:
                         rrsc_token.append(100)
@@ -236,49 +526,38 @@ class FuzzyFundMatcher:
                 improvement = rrsc_token > rrsc
                 rrsc = np.maximum(rrsc, rrsc_token)
 
-            # flag scores that are sufficiently high
-            valid = np.array([e >= valid_threshold for e in rrsc])
+            # flag registrant scores that are sufficiently high
+            valid_r = rrsc >= valid_threshold
 
             # check whether at least one match, otherwise abort
-            if ~valid.any():
+            if ~valid_r.any():
                 return None
 
-            # only keep remaining candidates
-            rcr, rcf = rcr[valid], rcf[valid]
-            rrsc = rrsc[valid]
-            rpos = rpos[valid]
-            if order_irrelevance:
-                improvement = improvement[valid]
-        except TypeError:
-            return None
-
-        # =========================================================================================
-        # FUND MATCHING
-        # =========================================================================================
-        # now find the best funds within the remaining candidates
-        try:
             # intialize fuzzy scorer
             fus = FuzzyScorer(to_match=fund,
                               digit_multiplier=digit_multiplier)
 
-            # compute score for every combination
+            # compute exact score for every combination with a valid registrant score
             rfsc = []
-            for choice in rcf:
-                fus.set_choice(choice)
-                rfsc.append(fus.compute_score())
+            for choice, cur_valid in zip(rcf, valid_r):
+                if cur_valid:
+                    fus.set_choice(choice)
+                    rfsc.append(fus.compute_score())
+                else:
+                    rfsc.append(0)
             rfsc = np.array(rfsc)
 
             # re-do with tokenized matching if no perfect match found yet
             if order_irrelevance:
                 rfsc_token = []
-                fus = FuzzyScorer(to_match=fund,
-                                  digit_multiplier=digit_multiplier,
-                                  sorted_token=True)
-                for choice, cur_rfsc in zip(rcf, rfsc):
+                # words of the choices are already sorted, only sort the current fund
+                fus = FuzzyScorer(to_match=FuzzyScorer.sort_and_token(fund),
+                                  digit_multiplier=digit_multiplier)
+                for choice, cur_rfsc, cur_valid in zip(choices_f_token[rinf], rfsc, valid_r):
                     # no need to try if score is zero
                     if cur_rfsc == 100:
                         rfsc_token.append(100)
-                    elif cur_rfsc < half_valid_threshold:
+                    elif cur_rfsc < half_valid_threshold or not cur_valid:
                         rfsc_token.append(0)
                     else:
                         fus.set_choice(choice)
@@ -289,8 +568,8 @@ class FuzzyFundMatcher:
                 improvement = improvement + (rfsc_token > rfsc)
                 rfsc = np.maximum(rfsc, rfsc_token)
 
-            # flag scores that are sufficiently high
-            valid = np.array([e >= valid_threshold for e in rfsc])
+            # flag combinations where both scores are sufficiently high
+            valid = valid_r & (rfsc >= valid_threshold)
 
             # check whether at least one match, otherwise abort
             if ~valid.any():
@@ -299,7 +578,7 @@ class FuzzyFundMatcher:
             # only keep remaining candidates
             rcr, rcf = rcr[valid], rcf[valid]
             rrsc, rfsc = rrsc[valid], rfsc[valid]
-            rpos = rpos[valid]
+            rpos, rord = rpos[valid], rord[valid]
             if order_irrelevance:
                 improvement = improvement[valid]
         except TypeError:
@@ -308,31 +587,26 @@ class FuzzyFundMatcher:
         # =========================================================================================
         # FINALIZE
         # =========================================================================================
-        # compute weighted score, round down, and convert to integer
-        scores_weighted = np.sqrt(rrsc*rfsc)
-        scores_weighted = np.floor(scores_weighted).astype(int)
-
-        # compute position of top n according to weighted score
-        # keep all matches if total number is less than top n
-        if (top_n is not None) and (len(scores_weighted) > top_n):
-            pos_top = np.argpartition(scores_weighted, -top_n)[-top_n:]
-            # argpartition does not ensure sorted order of top n, do this now
-            pos_top = pos_top[np.argsort(scores_weighted[pos_top])][::-1]
-        else:
-            # sorting still needed
-            pos_top = np.argsort(scores_weighted)[::-1]
+        # compute weighted score and round down to integer
+        # (scores are at most 100, so single precision is exact enough)
+        scores_weighted = np.sqrt(rrsc.astype(np.int32)*rfsc, dtype=np.float32).astype(np.int16)
+
+        # rank by weighted score (descending) and keep the top n, all matches if top_n is None
+        # equal scores are ranked by the original position of the choices, later choices first
+        # (the choices are sorted by registrant length, so their order in the arrays is arbitrary)
+        pos_top = np.lexsort((-rord, -scores_weighted))[:top_n]
         # return top n
         rcr, rcf = rcr[pos_top], rcf[pos_top]
-        picks = [f'{r} : {f}' for r, f in zip(rcr, rcf)]
+        picks = np.char.add(np.char.add(rcr, ' : '), rcf)
         scores_weighted = scores_weighted[pos_top]
         rpos = rpos[pos_top]
 
         # flag when order irrelevance improved matching
-        flag_m = [''] * len(pos_top)
         if order_irrelevance:
-            improvement = improvement[pos_top]
-            flag_m = ['OR' if imp else fl for fl, imp in zip(flag_m, improvement)]
+            flag_m = np.where(improvement[pos_top], 'OR', '')
+        else:
+            flag_m = np.full(len(pos_top), '')
 
-        # output is in format: [(fname1, score1, index1, flag1),
-        #                       (fname2, score2, index2, flag2), ...]
-        return list(zip(*[picks, scores_weighted, rpos, flag_m]))
+        # output is in format: ([fname1, fname2, ...], [score1, score2, ...],
+        #                       [index1, index2, ...], [flag1, flag2, ...])
+        return picks, scores_weighted, rpos, flag_m
@@ -13,8 +13,11 @@ Description: Fuzzy match scorer class
 # =================================================================================================
 # PACKAGES
 # =================================================================================================
-from fuzzywuzzy.StringMatcher import StringMatcher as SequenceMatcher
-# slower alternative: from difflib import SequenceMatcher
+from itertools import accumulate
+from math import ceil, floor
+import numpy as np
+from rapidfuzz import process
+from rapidfuzz.distance import Indel, Levenshtein
 
 
 # =================================================================================================
@@ -22,14 +25,14 @@ from fuzzywuzzy.StringMatcher import StringMatcher as SequenceMatcher
 # =================================================================================================
 class FuzzyScorer:
     """
-    The FuzzyScorer class is based on the Ratio measure of the SequenceMatcher.
+    The FuzzyScorer class is based on the Ratio measure of the SequenceMatcher (Levenshtein matching blocks).
     However, this class exands by allowing different penalties depending on the un-matched characters.
     In the current functionality, we can attach different weight to un-matched digits.
     """
 
     def __init__(self, to_match, choice=None, digit_multiplier=1, sorted_token=False):
         """
-        Initialize SequenceMatcher and set variables for later use
+        Set variables for later use
         Arguments:
             choice (string) - will be compared with other string; it is faster to change this string
             to_match (string) - will be compared with other string
@@ -42,14 +45,15 @@ class FuzzyScorer:
             self.seq1 = choice
             self.seq2 = to_match
 
-        self.seqmat = SequenceMatcher(isjunk=None, seq1=self.seq1, seq2=self.seq2)
+        # count the digits of the second string once, they are needed for the penalty
+        self.cum_digits2 = self.cumulative_digits(self.seq2)
 
         self.digit_multiplier = digit_multiplier
         self.sorted_token = sorted_token
 
     def set_choice(self, choice):
         """
-        It is faster to change the first string than the second, see SequenceMatcher documentation.
+        Change the first string, the second string and its digit counts are kept.
         Arguments:
             choice (string) - will be compared with other string
         """
@@ -57,7 +61,6 @@ class FuzzyScorer:
             self.seq1 = self.sort_and_token(choice)
         else:
             self.seq1 = choice
-        self.seqmat.set_seq1(self.seq1)
 
     def compute_score(self):
         """
@@ -70,44 +73,29 @@ class FuzzyScorer:
         if len1 == 0 or len2 == 0:
             return 0
 
-        if self.seqmat is None:
-            self.seqmat = SequenceMatcher(isjunk=None, seq1=self.seq1, seq2=self.seq2)
-
         # first identify the matching blocks for each string
-        matching_blocks = self.seqmat.get_matching_blocks()
-
-        # first identify the position of the un-matched characters for both strings
-        # diff holds the positions of the un-matched characters
-        diff_a, diff_b = [], []
-        cur_pos_a = cur_pos_b = 0
-        for start_a, start_b, length in matching_blocks:
+        # (the blocks of the Levenshtein edit operations, identical to the fuzzywuzzy SequenceMatcher)
+        matching_blocks = Levenshtein.editops(self.seq1, self.seq2).as_matching_blocks()
 
-            diff_a += list(range(cur_pos_a, start_a))
-            diff_b += list(range(cur_pos_b, start_b))
+        # now compute the number of matched characters
+        # match length is last entry in each tuple of matching_blocks() output
+        matches = sum(triple[-1] for triple in matching_blocks)
 
-            cur_pos_a = start_a + length
-            cur_pos_b = start_b + length
+        # matched characters are identical in both strings, so the un-matched digits are
+        # all digits minus twice the matched digits (counted with the cumulative digit count of seq2)
+        # un-matched digits only matter if they get a different penalty, and digits can only be
+        # matched if both strings contain digits
+        unmatched_digits = 0
+        if self.digit_multiplier != 1:
+            unmatched_digits = sum(map(str.isdigit, self.seq1)) + self.cum_digits2[-1]
+            if unmatched_digits > self.cum_digits2[-1] > 0:
+                unmatched_digits -= 2*sum(self.cum_digits2[start_b+length] - self.cum_digits2[start_b]
+                                          for _, start_b, length in matching_blocks)
 
         # compute the penalty score
         # this score is based on the number of un-matched characters for both strings,
         # where a multiplier is applied to digits
-        penalty = 0
-
-        for i in diff_a:
-            if self.seq1[i].isdigit():
-                penalty += self.digit_multiplier
-            else:
-                penalty += 1
-
-        for i in diff_b:
-            if self.seq2[i].isdigit():
-                penalty += self.digit_multiplier
-            else:
-                penalty += 1
-
-        # now compute the number of matched characters
-        # match length is last entry in each tuple of matching_blocks() output
-        matches = sum(triple[-1] for triple in matching_blocks)
+        penalty = len1 + len2 - 2*matches + (self.digit_multiplier-1)*unmatched_digits
 
         # final score is the ratio of matches and (matches+penalty)
         # between 0 and 100
@@ -122,14 +110,22 @@ class FuzzyScorer:
         seq1, seq2 = self.seq1, self.seq2
         self.seq1 = ' '.join(sorted(seq1.split()))
         self.seq2 = ' '.join(sorted(seq2.split()))
-        self.seqmat = SequenceMatcher(isjunk=None, seq1=self.seq1, seq2=self.seq2)
+        cum_digits2, self.cum_digits2 = self.cum_digits2, self.cumulative_digits(self.seq2)
 
         # compute score, retrieve backup and return
         score = self.compute_score()
         self.seq1, self.seq2 = seq1, seq2
-        self.seqmat = None
+        self.cum_digits2 = cum_digits2
         return score
 
+    @staticmethod
+    def cumulative_digits(seq):
+        """
+        Counts the digits up to every position in the string.
+        The difference of two entries gives the number of digits in the slice between them.
+        """
+        return list(accumulate(map(str.isdigit, seq or ''), initial=0))
+
     @staticmethod
     def sort_and_token(seq):
         """
@@ -149,3 +145,95 @@ class FuzzyScorer:
             return 100
 
         return int(100 * 2.0 * min(len1, len2) / (len1 + len2))
+
+
+# =================================================================================================
+# BATCH SCORING
+# =================================================================================================
+def length_ratio(length, lengths, digit_multiplier=1):
+    """
+    Returns an upper bound on the score for a string of a given length and many choice lengths at once.
+    There can't be more matches than the shorter length, so the score is at most the ratio of the
+    shorter and the longer length, which is tighter than real_quick_ratio.
+    This only holds for digit_multiplier >= 1; for a smaller multiplier, un-matched digits are cheaper
+    than other characters, and the penalty of the length difference is scaled down accordingly.
+    Arguments:
+        length (integer) - length of the string that will be compared with every choice
+        lengths (array of integers) - lengths of the choices
+        digit_multiplier (numeric, >0) - penalty multiplier for non-matched digits of the scorer
+    """
+    shorter, longer = np.minimum(length, lengths), np.maximum(length, lengths)
+    if digit_multiplier >= 1:
+        return np.where(longer > 0, (100*shorter) // np.maximum(longer, 1), 100)
+    # bound is shorter / (shorter + digit_multiplier*(longer-shorter))
+    penalized = shorter + digit_multiplier*(longer - shorter)
+    return np.where(longer > 0, np.floor(100*shorter / np.maximum(penalized, 1e-9) + 1e-9), 100).astype(int)
+
+
+def length_range(length, score_cutoff, digit_multiplier=1):
+    """
+    Returns the range (lo, hi) of choice lengths with a length_ratio of at least score_cutoff.
+    Arguments:
+        length (integer) - length of the string that will be compared with the choices
+        score_cutoff (numeric, in 0-100) - minimum score
+        digit_multiplier (numeric, >0) - penalty multiplier for non-matched digits of the scorer
+    """
+    # scores are integers, so a fractional cutoff requires the next integer
+    cutoff = ceil(score_cutoff)
+    if cutoff <= 0:
+        return 0, np.iinfo(np.int64).max
+    if digit_multiplier >= 1:
+        # shorter choices need 100*choice >= cutoff*length, longer choices need 100*length >= cutoff*choice
+        return -(-cutoff*length // 100), (100*length) // cutoff
+    # solve length_ratio >= cutoff for shorter and longer choices (rounded generously,
+    # a slightly wider range only keeps a few more candidates for the exact bounds)
+    s, scale = cutoff / 100, digit_multiplier
+    lo = floor(s*scale*length / (1 - s + s*scale) - 1e-9)
+    hi = ceil(length + length*(1 - s) / (s*scale) + 1e-9)
+    return max(lo, 0), hi
+
+
+def score_upper_bound(to_match, choices, score_cutoff=0, workers=1, digit_multiplier=1):
+    """
+    Returns an upper bound on the FuzzyScorer score of to_match and every choice in one call.
+    The bound assumes that all characters of the longest common subsequence are matched and that
+    un-matched digits are penalized as little as possible. The Indel distance is computed by
+    rapidfuzz in C for all choices at once.
+    Arguments:
+        to_match (string | array of strings) - will be compared with every choice; for an array,
+            the bounds of all combinations are returned as a matrix (to_match x choices)
+        choices (array of strings) - choices that will be compared with to_match
+        score_cutoff (numeric, in 0-100) - choices with a bound below the cutoff get a bound of 0,
+            which allows rapidfuzz to discard them early (e.g., by length difference)
+        workers (integer) - number of threads used by rapidfuzz, -1 uses all cores
+        digit_multiplier (numeric, >0) - penalty multiplier for non-matched digits of the scorer
+    """
+    single = isinstance(to_match, str)
+    queries = [to_match] if single else list(to_match)
+    choices = np.asarray(choices)
+    # total length of both strings for every combination
+    lengths = (np.fromiter((len(q) for q in queries), dtype=np.int32, count=len(queries))[:, None]
+               + np.fromiter((len(c) for c in choices), dtype=np.int32, count=len(choices))[None, :])
+    # the penalty of the un-matched characters is at least their number times the smallest multiplier,
+    # which is 1 unless digits are penalized less than other characters (digit_multiplier < 1)
+    scale = min(1, digit_multiplier)
+    # a bound of at least score_cutoff is equivalent to a normalized Indel distance
+    # (distance divided by total length) of at most (1-s)/(1-s+2*scale*s) with s = score_cutoff/100
+    # rejected choices are returned with a normalized distance of 1, i.e., no matches
+    cutoff = score_cutoff / 100
+    max_distance = (1 - cutoff) / (1 - cutoff + 2*scale*cutoff) + 1e-9
+    distances = process.cdist(queries, choices, scorer=Indel.normalized_distance,
+                              score_cutoff=max_distance, dtype=np.float32, workers=workers)
+    distances = np.rint(distances * lengths).astype(np.int32)
+    # number of matched characters follows from the Indel distance (deletions and insertions)
+    matches = (lengths - distances) // 2
+    # score is the ratio of matches and (matches+penalty), where penalty is at least scale*(lengths-2*matches)
+    # two empty strings are a perfect match
+    if scale == 1:
+        penalized = lengths - matches
+        bound = np.where(penalized > 0, (100*matches) // np.maximum(penalized, 1), 100)
+    else:
+        penalized = matches + scale*(lengths - 2*matches)
+        bound = np.where(penalized > 0, np.floor(100*matches / np.maximum(penalized, 1e-9) + 1e-9), 100)
+    bound = bound.astype(np.uint8)
+    return bound[0] if single else bound
@@ -18,15 +18,36 @@ import pandas as pd
 import numpy as np
 
 
+# ======================================================================================================================
+# CONSTANTS
+# ======================================================================================================================
+# translation table that deletes every ASCII character except letters, digits, and whitespace
+# (same characters as the regular expression [^a-zA-Z\d\s]+, which is used for non-ASCII strings)
+NON_ALNUM_TABLE = {i: None for i in range(128) if not (chr(i).isalnum() or chr(i).isspace())}
+NON_ALNUM_REGEX = re.compile(r'[^a-zA-Z\d\s]+')
+
+# extra spaces (any whitespace around at least one space)
+SPACE_REGEX = re.compile(r'\s* \s*')
+
+
 # ======================================================================================================================
 # FUNCTIONS
 # ======================================================================================================================
+def compile_trim_words(trim_words):
+    """
+    Compile a list of trim words into a single regular expression that matches any of the words.
+    Args:
+        trim_words - list of words that will be removed
+    """
+    return re.compile(r'\b(?:' + '|'.join(trim_words) + r')\b') if trim_words else None
+
+
 def preproc_string(strings, trim_words=None, regex_sub=None, rem_reg_from_fund=False):
     """
     This function preprocesses a string or a list of strings for fuzzy matching.
     Args:
         strings - string or list of strings, must be of the form 'REGISTRANT: FUND'
-        trim_words - list of words that will be removed
+        trim_words - list of words that will be removed (or pre-compiled with compile_trim_words)
         regex_sub (regex, sub) - pre-compiled regex substitution pairs
         rem_reg_from_word (boolean) - if true, removes all registrant words from fund name
     """
@@ -41,22 +62,29 @@ def preproc_string(strings, trim_words=None, regex_sub=None, rem_reg_from_fund=F
     # split registrant and fund name
     splits = [s.split(sep=':', maxsplit=1) for s in strings]
     st_r, st_f = zip(*[s if len(s) == 2 else s+[''] for s in splits])
-    # replace trim words with space (e.g., 'and', 'corp', and 'inc')
-    if trim_words is not None:
-        for trim_word in trim_words:
-            st_r = [re.sub(rf'\b{trim_word}\b', ' ', e) for e in st_r]
-            st_f = [re.sub(rf'\b{trim_word}\b', ' ', e) for e in st_f]
+    # process registrant and fund names together: first half are registrants, second half are funds
+    parts = list(st_r) + list(st_f)
+    # substitutions are applied only once to every distinct part, because the same registrant
+    # (and often the same fund name) appears in many strings
+    distinct = list(dict.fromkeys(parts))
+    parts, all_parts = distinct, parts
+    # replace trim words with space (e.g., 'and', 'corp', and 'inc'), all words in a single pass
+    trim_regex = trim_words if isinstance(trim_words, re.Pattern) else compile_trim_words(trim_words)
+    if trim_regex is not None:
+        parts = [trim_regex.sub(' ', e) for e in parts]
     # apply additional regex substitutions if specified
     if regex_sub is not None:
         for reg, sub in regex_sub:
-            st_r = [reg.sub(sub, e) for e in st_r]
-            st_f = [reg.sub(sub, e) for e in st_f]
+            parts = [reg.sub(sub, e) for e in parts]
     # keep only letters and digits; replace everything else with '' (empty)
-    st_r = [re.sub(r'[^a-zA-Z\d\s]+', '', e) for e in st_r]
-    st_f = [re.sub(r'[^a-zA-Z\d\s]+', '', e) for e in st_f]
-    # remove extra spaces and '&'
-    st_r = [re.sub(r'\s*[& ]\s*', ' ', e) for e in st_r]
-    st_f = [re.sub(r'\s*[& ]\s*', ' ', e) for e in st_f]
+    # str.translate is much faster than the regular expression for (the usual) ASCII strings
+    parts = [e.translate(NON_ALNUM_TABLE) if e.isascii() else NON_ALNUM_REGEX.sub('', e) for e in parts]
+    # remove extra spaces ('&' is already removed)
+    parts = [SPACE_REGEX.sub(' ', e) for e in parts]
+    # map the processed distinct parts back to all parts
+    processed = dict(zip(distinct, parts))
+    parts = [processed[e] for e in all_parts]
+    st_r, st_f = parts[:len(st_r)], parts[len(st_r):]
     # remove all registrants words also appearing in the fund
     if rem_reg_from_fund:
         st_f = [[word for word in f.split() if word not in r.split()] for r, f in zip(st_r, st_f)]
@@ -17,6 +17,9 @@ import os                               # Browse directories
 import csv                              # CSV documents
 import time
 import math
+import importlib.util
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd                     # DataFrames
 import numpy as np
 
@@ -34,6 +37,11 @@ NSAR_DIR = "'D:/path/subpath"
 # specify holdings directory
 HOLDING_DIR = "'D:/path/subpath"
 
+# keep a parquet copy of the holdings next to the Stata file, which is much faster to read
+# (created on the first run and again whenever the Stata file is newer)
+# optional dependency: requires pyarrow or fastparquet, otherwise the Stata file is read
+HOLDING_PARQUET = False
+
 # specify output directory
 OUTPUT_DIR = "'D:/path/subpath"
 OUTPUT_NAME = 'file_name.csv'
@@ -89,6 +97,171 @@ SEED = 15 # 13, 14, 15
 # toggle multi core processing on or off
 MULTI_PROCESSING = True
 
+# use threads instead of processes for multi core processing
+# (no start-up and copying costs, but the exact scoring in python does not run in parallel)
+MULTI_THREADING = False
+
+# match several quarters at the same time in separate processes (one quarter per core)
+# MULTI_PROCESSING and MULTI_THREADING are then ignored, so that workers don't start their own pools
+QUARTER_PROCESSING = False
+
+
+# =================================================================================================
+# QUARTER MATCHING
+# =================================================================================================
+# filings and holdings of the current worker process (for QUARTER_PROCESSING)
+_QUARTER_WORKER = {}
+
+
+def init_quarter_worker(nd, crsp):
+    """
+    Initialize a worker process: keep the sorted filings and holdings for all its quarters,
+    so that the tasks only contain the bounds of the slices instead of copies of the slices.
+    """
+    _QUARTER_WORKER['nd'], _QUARTER_WORKER['crsp'] = nd, crsp
+
+
+def slice_quarter(nd, crsp, nd_bounds, crsp_bounds, subset=None):
+    """
+    Returns the filings within the matching horizon and the CRSP funds of a quarter.
+    Arguments:
+        nd (DataFrame) - filings sorted by ryearmonth
+        crsp (DataFrame) - CRSP funds sorted by yearmonth
+        nd_bounds, crsp_bounds (tuple) - positions (start, end) of the slices
+        subset (array) - index of randomly selected CRSP funds, for testing purposes
+    """
+    # filings are put back in their original order, the matcher ranks equal scores by the position
+    # of the choices (later filings first), so the slice must not keep the year-month order
+    cur_nd = nd.iloc[slice(*nd_bounds)].sort_index()
+    cur_crsp = crsp.iloc[slice(*crsp_bounds)]
+    if subset is not None:
+        cur_crsp = cur_crsp.loc[subset]
+    return cur_nd, cur_crsp
+
+
+def match_quarter_worker(nd_bounds, crsp_bounds, subset, csv_header):
+    """
+    Run match_quarter for the slices of a quarter in a worker process (on a single core)
+    """
+    # the quarters already run on all cores, so rapidfuzz must not start threads of its own
+    cur_nd, cur_crsp = slice_quarter(_QUARTER_WORKER['nd'], _QUARTER_WORKER['crsp'],
+                                     nd_bounds, crsp_bounds, subset)
+    return match_quarter(cur_nd, cur_crsp, csv_header, False, False, workers=1)
+
+
+def match_quarter(cur_nd, cur_crsp, csv_header, multi_processing, multi_threading, workers=-1):
+    """
+    Fuzzy matches the CRSP funds of one quarter with the filings within its matching horizon.
+    Returns the rows for the CSV file and the number of matched CRSP funds.
+    Arguments:
+        cur_nd (DataFrame) - filings within the matching horizon
+        cur_crsp (DataFrame) - CRSP funds of the quarter
+        csv_header (list) - columns of the CSV file
+        multi_processing (boolean) - match on multiple cores within the quarter
+        multi_threading (boolean) - use threads instead of processes for multi_processing
+        workers (integer) - number of threads rapidfuzz uses for the registrant bounds (-1 for all cores)
+    """
+    # fuzzy match
+    # initialize
+    fm = FuzzyFundMatcher(to_matches=cur_crsp['fund_name'], choices=cur_nd['match_name'])
+    # string preprocessing
+    fm.preproc(trim_words=TRIM_WORDS, regex_sub=REGEX_SUB,
+               rem_reg_from_fund=REM_REG_FROM_FUND)
+    # adjust number_matches variable (None returns all matches satisfying VALID_THRESHOLD in LONG
+    # and only the best match in WIDE)
+    number_matches = NUMBER_MATCHES if (NUMBER_MATCHES is not None) or (OUTPUT_FORMAT == 'LONG') else 1
+    # do the matching
+    matches = fm.find_best(top_n=number_matches, valid_threshold=VALID_THRESHOLD,
+                           digit_multiplier=DIGIT_MULTIPLIER, multi_processing=multi_processing,
+                           quick_comparison=QUICK_COMPARISON, order_irrelevance=ORDER_IRRELEVANCE,
+                           multi_threading=multi_threading, workers=workers)
+    # shut down worker processes and release the shared memory
+    fm.close_pool()
+
+    # nothing to write if no fund got matched
+    if len(matches) == 0:
+        return [], 0
+
+    # positions of the matched funds in cur_crsp (one entry per match)
+    rows = matches['row']
+
+    # prepare columns for data frame conversion
+    mat_cols = ['m_name_preproc', 'm_score', 'm_pos', 'm_flag']
+    matches = pd.DataFrame({'row': rows, 'crsp_name_preproc': matches['to_match'],
+                            'm_name_preproc': matches['pick'], 'm_score': matches['score'],
+                            'm_pos': matches['pos'], 'm_flag': matches['flag']})
+
+    if OUTPUT_FORMAT == 'WIDE':
+        # matches are sorted by fund and score, so the rank of a match is its position
+        # within the matches of the same fund (rows are sorted, searchsorted finds the first)
+        # resulting format: [[to_match, m_name1, m_score1,
+        #                     m_pos1, m_name2, m_score2, m_pos2, ...], ...]
+        rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+        first = rank == 0
+        fund = np.cumsum(first) - 1
+
+        # preallocate the top N matches of every fund and scatter the matches into it,
+        # columns of matches that were not reported keep None
+        indices = np.repeat(list(range(1, number_matches+1)), len(mat_cols))
+        columns = [e1+str(e2) for e1, e2 in zip(mat_cols*number_matches, indices)]
+        wide = np.empty((first.sum(), len(columns)), dtype=object)
+        for j, col in enumerate(mat_cols):
+            wide[fund, rank*len(mat_cols) + j] = matches[col].values
+        to_match = matches['crsp_name_preproc'].values[first]
+        matches = pd.DataFrame(wide, columns=columns)
+        matches.insert(0, 'crsp_name_preproc', to_match)
+
+        # only keep the funds that got matched
+        cur_crsp = cur_crsp.iloc[rows[first]]
+
+    elif OUTPUT_FORMAT == 'LONG':
+        # resulting format: [[to_match, m_name1, m_score1, ...],
+        #                    [to_match, m_name2, m_score2, ...], ...]
+        # also add crsp fundno and crsp yearmonth, repeated for each match
+        matches['crsp_fundno'] = cur_crsp['crsp_fundno'].values[rows]
+        matches['crsp_yearmonth'] = cur_crsp['yearmonth'].values[rows]
+        matches['crsp_name_orig'] = cur_crsp['fund_name'].values[rows]
+        matches = matches.drop(columns='row')
+
+        # only keep the funds that got matched
+        cur_crsp = cur_crsp.iloc[np.unique(rows)]
+
+    # filing information of the matches, m_pos is the index of cur_nd,
+    # so the rows are gathered directly instead of merged
+    nd_cols = ['cik', 'fdate', 'match_name', 'fund_id', 'file_name']
+    m_cols = ['m_cik', 'm_fdate', 'm_name_orig', 'm_fund_id', 'm_file_name']
+
+    if OUTPUT_FORMAT == 'WIDE':
+        # use positional identifiers to retrieve cik, fdate and original names again again
+        for i in range(1, number_matches+1):
+            # first make sure m_pos column is numeric
+            # (it is an object column when it was filled up with empty matches)
+            if not pd.api.types.is_numeric_dtype(matches[f'm_pos{i}']):
+                matches[f'm_pos{i}'] = pd.to_numeric(matches[f'm_pos{i}'])
+            # now gather on m_pos column (empty matches get empty information)
+            info = cur_nd[nd_cols].reindex(matches[f'm_pos{i}'].values)
+            # apply suffix to gathered info (cik, fdate, match_name, fund_id, file_name)
+            for col, m_col in zip(nd_cols, m_cols):
+                matches[f'{m_col}{i}'] = info[col].values
+
+        # add crsp fund name, fund number, year and month
+        matches['crsp_name_orig'] = cur_crsp['fund_name'].values
+        matches['crsp_fundno'] = cur_crsp['crsp_fundno'].values
+        matches['crsp_yearmonth'] = cur_crsp['yearmonth'].values
+
+    elif OUTPUT_FORMAT == 'LONG':
+        info = cur_nd[nd_cols].reindex(matches['m_pos'].values)
+        for col, m_col in zip(nd_cols, m_cols):
+            matches[m_col] = info[col].values
+
+    # rows for the csv file
+    # (dates are written without time and missing values as empty fields, like pandas does)
+    matches = matches[csv_header]
+    for col in matches.select_dtypes('datetime').columns:
+        matches[col] = matches[col].dt.strftime('%Y-%m-%d')
+    matches = matches.astype(object).where(matches.notna(), None)
+    return list(matches.itertuples(index=False, name=None)), len(cur_crsp)
+
 
 # =================================================================================================
 # MULTIPROCESSING
@@ -107,57 +280,88 @@ if __name__ == '__main__':
     fd = fd[["cik", "fdate", "fund", "fund_id", "file_name"]]
 
     # drop full duplicates
-    rd = rd[~rd.duplicated()]
-    fd = fd[~fd.duplicated()]
+    rd = rd.drop_duplicates(ignore_index=True)
+    fd = fd.drop_duplicates(ignore_index=True)
 
     # merge registrant with fund name to create nd (names data)
     nd = rd.merge(fd, how='left', on="file_name", validate="1:m", suffixes=('', '_y'))
 
-    # replace NaN with empty string
-    nd = nd.replace(np.nan, '', regex=True)
+    # replace NaN with empty string in the name columns (numeric columns keep their dtype)
+    str_cols = ['reg_name', 'fund', 'fund_id', 'file_name']
+    nd[str_cols] = nd[str_cols].fillna('')
 
     # drop incomplete data
-    nd = nd[nd.fdate != '']
+    nd = nd[nd.fdate.notna() & (nd.fdate != '')]
 
     # combine registrant and fund names
     nd['match_name'] = nd["reg_name"] + " : " + nd["fund"]
 
+    # names repeat across many filings, categoricals store every name once
+    # (the matcher preprocesses the categories instead of every row)
+    for col in ['reg_name', 'match_name', 'file_name']:
+        nd[col] = nd[col].astype('category')
+
     # drop duplicates
-    nd = nd[~nd.duplicated(subset=['rdate', 'match_name'])]
+    nd = nd.drop_duplicates(subset=['rdate', 'match_name'])
+
+    # year-month, computed on the raw YYYYMMDD dates
+    nd["ryearmonth"] = pd.to_numeric(nd["rdate"], errors='coerce') // 100
+    nd["fyearmonth"] = pd.to_numeric(nd["fdate"], errors='coerce') // 100
+
+    # drop filings without report date, they are never within a matching horizon
+    nd = nd[nd.ryearmonth.notna()]
+
+    # narrow integer types (year-months fit into int32, years into int16, and months into int8)
+    nd = nd.astype({"ryearmonth": np.int32, "fyearmonth": np.int32})
+    nd["fyear"] = (nd["fyearmonth"] // 100).astype(np.int16)
+    nd["ryear"] = (nd["ryearmonth"] // 100).astype(np.int16)
+    nd["fmonth"] = (nd["fyearmonth"] % 100).astype(np.int8)
+    nd["rmonth"] = (nd["ryearmonth"] % 100).astype(np.int8)
 
     # convert date format
     nd["fdate"] = pd.to_datetime(nd["fdate"], format="%Y%m%d")
     nd["rdate"] = pd.to_datetime(nd["rdate"], format="%Y%m%d")
-    nd["fyear"], nd["ryear"] = nd["fdate"].dt.year, nd["rdate"].dt.year
-    nd["fmonth"], nd["rmonth"] = nd["fdate"].dt.month, nd["rdate"].dt.month
-
-    # year-month
-    nd["ryearmonth"] = 100*nd["ryear"] + nd["rmonth"]
-    nd["fyearmonth"] = 100*nd["fyear"] + nd["fmonth"]
 
 
     # =============================================================================================
     # LOAD AND PREPROCESS HOLDINGS DATA
     # =============================================================================================
-    # load crsp (CRSP holdings)
-    crsp = pd.read_stata(os.path.join(HOLDING_DIR, 'CRSP_fund_characteristics_quarterly.dta'))
-
-    # keep only relevant columns
-    crsp = crsp[['caldt', 'fund_name', 'crsp_fundno']]
+    # load crsp (CRSP holdings), only relevant columns
+    crsp_cols = ['caldt', 'fund_name', 'crsp_fundno']
+    dta_path = os.path.join(HOLDING_DIR, 'CRSP_fund_characteristics_quarterly.dta')
+    parquet_engine = any(importlib.util.find_spec(engine) for engine in ['pyarrow', 'fastparquet'])
+    if HOLDING_PARQUET and not parquet_engine:
+        print("HOLDING_PARQUET requires pyarrow or fastparquet, reading the Stata file instead.")
+    if HOLDING_PARQUET and parquet_engine:
+        # convert the Stata file once, afterwards only the parquet copy is read
+        parquet_path = os.path.splitext(dta_path)[0] + '.parquet'
+        if not os.path.exists(parquet_path) or os.path.getmtime(parquet_path) < os.path.getmtime(dta_path):
+            pd.read_stata(dta_path, columns=crsp_cols).to_parquet(parquet_path, index=False)
+        crsp = pd.read_parquet(parquet_path, columns=crsp_cols)
+    else:
+        crsp = pd.read_stata(dta_path, columns=crsp_cols)
 
     # drop incomplete data
     crsp = crsp[crsp.fund_name != ""]
 
     # remove shares class info in crsp fund names
-    crsp['fund_name'] = [entry.rsplit(sep=";", maxsplit=1)[0] for entry in crsp['fund_name']]
+    # (applied to each distinct name of the categorical once, rpartition is a single call per name,
+    # names without share class are kept as they are)
+    crsp['fund_name'] = crsp['fund_name'].astype('category')
+    crsp['fund_name'] = crsp['fund_name'].map(lambda entry: entry.rpartition(";")[0] if ";" in entry
+                                              else entry)
+
+    # fund names repeat every quarter, categoricals store every name once
+    crsp['fund_name'] = crsp['fund_name'].astype('category')
+
+    # year-month, computed on the raw YYYYMMDD dates
+    # (narrow integer types, year-months fit into int32, years into int16, and months into int8)
+    crsp["yearmonth"] = (pd.to_numeric(crsp["caldt"]) // 100).astype(np.int32)
+    crsp["year"] = (crsp["yearmonth"] // 100).astype(np.int16)
+    crsp["month"] = (crsp["yearmonth"] % 100).astype(np.int8)
 
     # convert date format
     crsp["caldt"] = pd.to_datetime(crsp["caldt"], format="%Y%m%d")
-    crsp["year"] = crsp["caldt"].dt.year
-    crsp["month"] = crsp["caldt"].dt.month
-
-    # year-month
-    crsp["yearmonth"] = 100*crsp["year"] + crsp["month"]
 
 
     # =============================================================================================
@@ -165,7 +369,8 @@ if __name__ == '__main__':
     # =============================================================================================
     # create empty CSV file that will be filled, and prepare writer
     csv_matches = open(os.path.join(OUTPUT_DIR, OUTPUT_NAME), 'w', newline='')
-    writer_matches = csv.writer(csv_matches)
+    # (rows end with the line separator of the system, like pandas' to_csv)
+    writer_matches = csv.writer(csv_matches, lineterminator=os.linesep)
 
     # prepare and write CSV header
     csv_header = ['crsp_fundno', 'crsp_yearmonth', 'crsp_name_orig', 'crsp_name_preproc']
@@ -173,16 +378,17 @@ if __name__ == '__main__':
                'm_fdate', 'm_fund_id', 'm_file_name']
 
     if OUTPUT_FORMAT == 'WIDE':
+        # NUMBER_MATCHES = None reports only the best match (see match_quarter)
+        number_matches = NUMBER_MATCHES if NUMBER_MATCHES is not None else 1
         number_outputs = len(outputs)
-        outputs = outputs*NUMBER_MATCHES
-        indices = np.repeat(list(range(1, NUMBER_MATCHES+1)), number_outputs)
+        outputs = outputs*number_matches
+        indices = np.repeat(list(range(1, number_matches+1)), number_outputs)
         csv_header += [f"{name}{i}" for i, name in zip(indices, outputs)]
 
     elif OUTPUT_FORMAT == 'LONG':
         csv_header += outputs
 
     writer_matches.writerow(csv_header)
-    csv_matches.close()
 
 
     # =============================================================================================
@@ -192,9 +398,42 @@ if __name__ == '__main__':
     COUNT = 0
 
     # loop through quarters
-    years = crsp.year.unique()
+    # (as python integers, the year-month arithmetic would overflow int16)
+    years = crsp.year.unique().tolist()
     months = [e*3 for e in range(1, 5)]
 
+    # sort filings and holdings by year-month once, so that every matching horizon and quarter
+    # is a contiguous slice found by binary search instead of a boolean mask over all rows
+    # (stable sort, the original index is kept for the positional identifiers)
+    nd = nd.sort_values('ryearmonth', kind='stable')
+    crsp = crsp.sort_values('yearmonth', kind='stable')
+    nd_yearmonth = nd['ryearmonth'].to_numpy()
+    crsp_yearmonth = crsp['yearmonth'].to_numpy()
+
+    # quarters that are matched (or submitted) but not written yet, in order
+    pending = deque()
+    if QUARTER_PROCESSING:
+        workers = os.cpu_count()
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=init_quarter_worker,
+                                       initargs=(nd, crsp))
+
+    def write_quarter(year, month, start, result):
+        """
+        Writes the rows of a matched quarter to the CSV file and notifies about time elapsed.
+        """
+        rows, number_matched = result.result() if QUARTER_PROCESSING else result
+
+        # write to csv file, the file stays open during the whole loop
+        # (nothing to write if no fund got matched)
+        if number_matched > 0:
+            writer_matches.writerows(rows)
+            csv_matches.flush()
+
+        # notify about finish and time elapsed
+        time_change = time.strftime("%H hours, %M minutes, and %S seconds",
+                                    time.gmtime(time.time()-start))
+        print(f"Finished matching {number_matched} filings of {year}/{month} in {time_change}.")
+
     for year in years:
 
         for month in months:
@@ -210,101 +449,41 @@ if __name__ == '__main__':
             start_yearmonth = 100*start_year + start_month
             end_yearmonth = 100*end_year + end_month
 
-            # restrict matching on filings within the matching horizon
-            cur_nd = nd[nd.ryearmonth.between(start_yearmonth, end_yearmonth)]
-            cur_crsp = crsp[(crsp.year == year) & (crsp.month == month)]
+            # restrict matching on filings within the matching horizon and on holdings of the quarter
+            nd_bounds = tuple(np.searchsorted(nd_yearmonth, [start_yearmonth, end_yearmonth + 1]))
+            crsp_bounds = tuple(np.searchsorted(crsp_yearmonth, [100*year + month, 100*year + month + 1]))
 
             # check whether there are observations left in both sets
-            if len(cur_nd) == 0 or len(cur_crsp) == 0:
+            if nd_bounds[0] == nd_bounds[1] or crsp_bounds[0] == crsp_bounds[1]:
                 break
 
             # subset randomly selected for testing purposes
+            subset = None
             if SUBSET_SIZE is not None:
                 if SEED is not None:
                     np.random.seed(SEED)
-                random_choice = np.random.choice(a=cur_crsp.index, size=SUBSET_SIZE, replace=False)
-                cur_crsp = cur_crsp.loc[random_choice]
-
-            # fuzzy match
-            # initialize
-            fm = FuzzyFundMatcher(to_matches=cur_crsp['fund_name'], choices=cur_nd['match_name'])
-            # string preprocessing
-            fm.preproc(trim_words=TRIM_WORDS, regex_sub=REGEX_SUB,
-                       rem_reg_from_fund=REM_REG_FROM_FUND)
-            # adjust number_matches variable (None returns all matches satisfying NUMBER_MATCHES)
-            number_matches = NUMBER_MATCHES if (NUMBER_MATCHES is not None) or (OUTPUT_FORMAT == 'LONG') else 1
-            # do the matching
-            matches = fm.find_best(top_n=NUMBER_MATCHES, valid_threshold=VALID_THRESHOLD,
-                                   digit_multiplier=DIGIT_MULTIPLIER, multi_processing=MULTI_PROCESSING,
-                                   quick_comparison=QUICK_COMPARISON, order_irrelevance=ORDER_IRRELEVANCE)
-
-            # identify the funds that got matched
-            matched = np.array([e is not None for e in matches])
-            matches = [e for e in matches if e is not None]
-            cur_crsp = cur_crsp[matched]
-
-            # prepare columns for data frame conversion
-            columns = ['crsp_name_preproc']
-            mat_cols = ['m_name_preproc', 'm_score', 'm_pos', 'm_flag']
-
-            if OUTPUT_FORMAT == 'WIDE':
-                # flatten the list of lists (slist stands for sub-list)
-                # original format:  [[to_match, (m_name1, m_score1, m_pos1, m_flag1),
-                #                               (m_name2, m_score2, m_pos2, m_flag2)], ...]
-                # resulting format: [[to_match, m_name1, m_score1,
-                #                     m_pos1, m_name2, m_score2, m_pos2, ...], ...]
-                matches = [[m.to_match]+[e for sl in m.matches for e in sl] for m in matches]
-
-                # fill up top N matches with '' if less than N reported
-                matches = [e + [None]*(1+NUMBER_MATCHES*len(mat_cols)-len(e)) for e in matches]
-
-                indices = np.repeat(list(range(1, NUMBER_MATCHES+1)), len(mat_cols))
-                columns += [e1+str(e2) for e1, e2 in zip(mat_cols*NUMBER_MATCHES, indices)]
-
-            elif OUTPUT_FORMAT == 'LONG':
-                # resulting format: [[to_match, m_name1, m_score1, ...],
-                #                    [to_match, m_name2, m_score2, ...], ...]
-                # also add crsp fundno and crsp yearmonth
-                tmp = []
-                for m, fundno, yearmonth, fundname in zip(matches, cur_crsp['crsp_fundno'],
-                                                          cur_crsp['yearmonth'], cur_crsp['fund_name']):
-                    for sl in m.matches:
-                        tmp.append([m.to_match] + list(sl) + [fundno, yearmonth, fundname])
-                matches = tmp
-                columns += mat_cols + ['crsp_fundno', 'crsp_yearmonth', 'crsp_name_orig']
-
-            # convert to dataframe
-            matches = pd.DataFrame(matches, columns=columns)
-
-            if OUTPUT_FORMAT == 'WIDE':
-                # use positional identifiers to retrieve cik, fdate and original names again again
-                for i in range(1, NUMBER_MATCHES+1):
-                    # first make sure m_pos column is numeric
-                    # (it could be non-numeric when it's empty)
-                    matches[f'm_pos{i}'] = pd.to_numeric(matches[f'm_pos{i}'])
-                    # now merge on m_pos column
-                    matches = matches.merge(cur_nd[['cik', 'fdate', 'match_name']], how='left',
-                                            left_on=f'm_pos{i}', right_index=True, validate="m:1")
-                    # apply suffix to merged info (cik, fdate, match_name, m_name_orig)
-                    rename_dict = {'cik':f'm_cik{i}', 'fdate':f'm_fdate{i}', 'match_name': f'm_name_orig{i}'}
-                    matches.rename(columns=rename_dict, inplace=True)
-
-                    # add crsp fund name, fund number, year and month
-                    matches['crsp_name_orig'] = cur_crsp['fund_name'].values
-                    matches['crsp_fundno'] = cur_crsp['crsp_fundno'].values
-                    matches['crsp_yearmonth'] = cur_crsp['yearmonth'].values
-
-            elif OUTPUT_FORMAT == 'LONG':
-                matches = matches.merge(cur_nd[['cik', 'fdate', 'match_name', 'fund_id', 'file_name']],
-                                        how='left', left_on='m_pos', right_index=True, validate="m:1")
-                rename_dict = {'cik':'m_cik', 'fdate':'m_fdate', 'match_name': 'm_name_orig',
-                               'fund_id': 'm_fund_id', 'file_name': 'm_file_name'}
-                matches.rename(columns=rename_dict, inplace=True)
-
-            # write to csv file
-            matches[csv_header].to_csv(os.path.join(OUTPUT_DIR, OUTPUT_NAME), mode='a', header=False, index=False)
-
-            # notify about finish and time elapsed
-            time_change = time.strftime("%H hours, %M minutes, and %S seconds",
-                                        time.gmtime(time.time()-start))
-            print(f"Finished matching {len(cur_crsp)} filings of {year}/{month} in {time_change}.")
+                subset = np.random.choice(a=crsp.index[slice(*crsp_bounds)], size=SUBSET_SIZE, replace=False)
+
+            # match the quarter, either right away or in a worker process
+            # (workers hold nd and crsp since their start, only the bounds of the slices are sent)
+            if QUARTER_PROCESSING:
+                pending.append((year, month, start, executor.submit(
+                    match_quarter_worker, nd_bounds, crsp_bounds, subset, csv_header)))
+            else:
+                cur_nd, cur_crsp = slice_quarter(nd, crsp, nd_bounds, crsp_bounds, subset)
+                pending.append((year, month, start, match_quarter(
+                    cur_nd, cur_crsp, csv_header, MULTI_PROCESSING, MULTI_THREADING)))
+
+            # write finished quarters in order, but keep enough quarters submitted to use all cores
+            while pending and (not QUARTER_PROCESSING or len(pending) > 2*workers):
+                write_quarter(*pending.popleft())
+
+    # write the remaining quarters
+    while pending:
+        write_quarter(*pending.popleft())
+
+    if QUARTER_PROCESSING:
+        executor.shutdown()
+
+    # all quarters are written
+    csv_matches.close()
@@ -11,6 +11,8 @@ Last Modified: Wednesday, 12th January 2022 9:54:26 pm
 Description: The file contains the list of regular expressions that will be applied.
 The whole purpose of this file is to free up space in 1_fuzzy_match.py
 '''
+import re
+
 # word replacements in the format: ('word', 'replacement')
 wrd_rplc = [('intl', 'international'),
             ('mgd', 'managed'),
@@ -98,8 +100,47 @@ wrd_rplc = [('intl', 'international'),
             ('interm|inter|intermed', 'intermediate'),
             ('wells fargo', 'wells fargo advantage')]
 
-# surround first 'word' with non-characters to avoid capturing fragments within a longer word
-wrd_rplc = [(rf'(^|[^a-zA-Z])({word})([^a-zA-Z]|$)', rf'\1{sub}\3') for word, sub in wrd_rplc]
+# the words are replaced one after the other, e.g., 'mkts' -> 'markets' -> 'market'
+# consecutive words that can not interact, i.e., words and substitutions share no letter tokens,
+# are replaced in a single pass, words with other regex characters (e.g., 'trans.') or an empty
+# substitution are replaced in a pass of their own
+def letter_tokens(text):
+    """
+    Words of letters only, other characters are word boundaries in the regular expressions
+    """
+    return set(re.findall('[a-z]+', text))
+
+
+def is_plain(word, sub):
+    """
+    Whether the word only consists of letters, digits, spaces, and alternatives, with a non-empty substitution
+    """
+    return re.fullmatch(r'[a-z\d |]+', word) is not None and sub != ''
+
+
+wrd_passes = [[]]
+for word, sub in wrd_rplc:
+    cur_pass = wrd_passes[-1]
+    if cur_pass and not (is_plain(word, sub) and all(is_plain(*e) for e in cur_pass)
+                         and all(letter_tokens(' '.join(e)).isdisjoint(letter_tokens(word)) for e in cur_pass)):
+        wrd_passes.append([])
+    wrd_passes[-1].append((word, sub))
+
+
+def word_pass(words):
+    """
+    One regex that replaces all words of a pass, every word has its own group to find its substitution
+    (surround the words with non-characters to avoid capturing fragments within a longer word)
+    """
+    # the lookarounds do not consume the neighbouring character, so two adjacent matches of the same
+    # entry are both replaced (e.g., 'interm inter', 'mm,mmkt', 'portf port', or '"b" "a"' removed
+    # completely), the former patterns consumed the separator and skipped the second match
+    regex = r'(?<![a-zA-Z])(?:' + '|'.join(f'({word})' for word, _ in words) + r')(?![a-zA-Z])'
+    subs = [sub for _, sub in words]
+    return regex, lambda match: subs[match.lastindex-1]
+
+
+wrd_rplc = [word_pass(words) for words in wrd_passes]
 
 # regular sub expressions that will be applied with re.sub on string s
 # e.g., REGEX_SUB = [(f'/.{2,3}/\s*$', '')] removes /MA/ at end of the line
@@ -112,4 +153,5 @@ REGEX_SUB = [("'", ''),
              (r'/', ' '),
              (r'\.', ' ')]                          # replace period with space
 
-REGEX_SUB = REGEX_SUB + wrd_rplc
+# pre-compile all regular expressions once, so every substitution is a direct pattern.sub call
+REGEX_SUB = [(re.compile(regex), sub) for regex, sub in REGEX_SUB + wrd_rplc]